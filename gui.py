@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 from pathlib import Path
 import traceback
 
@@ -142,12 +143,29 @@ class ParametersPanel(QGroupBox):
         self.layout.addWidget(QLabel("Pixelation factor"))
         self.layout.addWidget(self.pixelation_factor_input)
 
+        self.detect_every_input = QSpinBox()
+        self.detect_every_input.setRange(1, 30)
+        self.detect_every_input.setSingleStep(1)
+        self.detect_every_input.setValue(1)
+        self.detect_every_input.setSuffix(" кадр.")
+        self.detect_every_input.setToolTip(
+            "Как часто искать лица в видео.\n"
+            "На остальных кадрах пикселизируются области лиц с последнего поиска.\n"
+            "Чем выше значение, тем быстрее обработка, но движущиеся лица могут выйти за область пикселизации.\n"
+            "Принимает целые значения от 1 до 30."
+        )
+
+        self.layout.addWidget(QLabel("Поиск лиц в видео каждые N кадров"))
+        self.layout.addWidget(self.detect_every_input)
+
         self.img_window_sizes = QLineEdit()
         self.img_window_sizes.setText("400, 700")
         self.img_window_sizes.setToolTip(
             "Размеры окон обнаружения лиц в пикселях.\n"
             "Чем больше и меньше (до разумного предела) окна, тем выше вероятность обнаружения лица.\n"
             "Но это также увеличивает время обработки.\n"
+            "Если оставить пустым, лица ищутся только на всём кадре целиком:\n"
+            "это намного быстрее, но небольшие лица на больших кадрах не будут найдены.\n"
             "Принимает список целых чисел, разделенных запятыми."
         )
 
@@ -157,12 +175,20 @@ class ParametersPanel(QGroupBox):
         self.setLayout(self.layout)
 
     def get_parameters(self):
+        try:
+            window_sizes = [
+                int(x) for x in self.img_window_sizes.text().split(",") if x.strip()
+            ]
+        except ValueError:
+            return None
+
         return {
             "confidence": self.confidence_input.value(),
             "face_min_size": self.face_min_size_input.value(),
             "face_expand": self.face_expand_input.value(),
             "pixelation_factor": self.pixelation_factor_input.value(),
-            "window_sizes": [int(x) for x in self.img_window_sizes.text().split(",")],
+            "window_sizes": window_sizes,
+            "detect_every": self.detect_every_input.value(),
         }
 
 
@@ -232,6 +258,7 @@ class ExecutionPanel(QGroupBox):
         super().__init__()
         self._parent = parent
         self.threadpool = QThreadPool()
+        self.face_anonymizer = None
 
         self.setTitle("Выполнение")
 
@@ -280,9 +307,12 @@ class ExecutionPanel(QGroupBox):
         self.global_progress.setValue(0)
         self.local_progress.setValue(0)
 
-        self.face_anonymizer = FaceAnonymizer(
-            **self._parent.parameters_panel.get_parameters()
-        )
+        # Keep the detector between runs, only the parameters are updated
+        parameters = self._parent.parameters_panel.get_parameters()
+        if self.face_anonymizer is None:
+            self.face_anonymizer = FaceAnonymizer(**parameters)
+        else:
+            self.face_anonymizer.set_parameters(**parameters)
 
         if self._parent.file_panel.selected_type == "dir":
             to_run = self.face_anonymizer.process_dir
@@ -311,9 +341,13 @@ class ExecutionPanel(QGroupBox):
 
     def global_progress_update(self, data):
         progress, filetype, filename = data
+        self.global_progress.setValue(int(progress * 100))
+        # Images finished in the background don't change the file in progress
+        if filetype == "finished":
+            return
+
         self.local_progress.setValue(0 if filetype == "video" else 100)
         self.local_progress_label.setText(f"Обработка: {filename}")
-        self.global_progress.setValue(int(progress * 100))
 
     def local_progress_update(self, progress):
         self.local_progress.setValue(int(progress * 100))
@@ -364,6 +398,9 @@ def set_taskbar_icon():
 
 
 if __name__ == "__main__":
+    # Required for the image process pool in the frozen build
+    multiprocessing.freeze_support()
+
     app = QApplication(sys.argv)
 
     app_icon = QIcon()
@@ -1,10 +1,19 @@
+import os
+import functools
+import multiprocessing
 import math
+import queue
 import random
+import threading
 from pathlib import Path
-from itertools import chain
+from fractions import Fraction
+from itertools import chain, count
+from concurrent.futures import ProcessPoolExecutor, wait
 
+import av
 import cv2
 import click
+import numpy as np
 
 from mediapipe.python.solutions import face_detection
 from mediapipe.python.solutions import drawing_utils
@@ -15,6 +24,72 @@ video_extensions = [".mp4", ".avi", ".mov"]
 image_extensions = [".jpg", ".jpeg", ".png"]
 supported_extensions = video_extensions + image_extensions
 
+# Output video encoders with their options, in order of preference:
+# hardware H.264 first, then software H.264, then plain MPEG-4
+video_encoders = [
+    ("h264_nvenc", {"preset": "p4", "cq": "23"}),
+    ("h264_amf", {}),
+    ("libx264", {"preset": "veryfast", "crf": "23"}),
+    ("mpeg4", {}),
+]
+
+# Sentinel passed through the video pipeline queues
+_end_of_stream = object()
+
+
+@functools.lru_cache(maxsize=None)
+def get_video_encoder(width, height):
+    """Return the first encoder from video_encoders that can be opened on
+    this machine for the given frame size."""
+    for name, options in video_encoders:
+        try:
+            codec_context = av.CodecContext.create(name, "w")
+            codec_context.width = width
+            codec_context.height = height
+            codec_context.pix_fmt = "yuv420p"
+            codec_context.time_base = Fraction(1, 25)
+            codec_context.options = dict(options)
+            # Fails without the matching GPU or driver
+            codec_context.open()
+        except (ValueError, av.error.FFmpegError):
+            continue
+        return name, options
+
+    raise RuntimeError(f"No video encoder available for {width}x{height} frames")
+
+
+def expand_clamp(boxes, windows, expand, min_size):
+    """Turn (xmin, ymin, width, height) detections, relative to the window
+    each one was found in, into (x1, y1, x2, y2) frame pixel boxes: expand
+    them, clamp to their window and drop the ones smaller than min_size."""
+    w = windows[:, 2] - windows[:, 0]
+    h = windows[:, 3] - windows[:, 1]
+
+    # Calculate the bounding boxes, truncating like int() does
+    x1 = (boxes[:, 0] * w).astype(np.int64)
+    y1 = (boxes[:, 1] * h).astype(np.int64)
+    x2 = ((boxes[:, 0] + boxes[:, 2]) * w).astype(np.int64)
+    y2 = ((boxes[:, 1] + boxes[:, 3]) * h).astype(np.int64)
+
+    # Make the bounding boxes bigger
+    x1 -= (expand * (x2 - x1)).astype(np.int64)
+    y1 -= (expand * (y2 - y1)).astype(np.int64)
+    x2 += (expand * (x2 - x1)).astype(np.int64)
+    y2 += (expand * (y2 - y1)).astype(np.int64)
+
+    # Keep the bounding boxes within their window bounds
+    np.maximum(x1, 0, out=x1)
+    np.maximum(y1, 0, out=y1)
+    np.minimum(x2, w, out=x2)
+    np.minimum(y2, h, out=y2)
+
+    # Drop the bounding boxes that are too small
+    keep = (x2 - x1 >= min_size) & (y2 - y1 >= min_size)
+
+    # Move the bounding boxes from window to frame coordinates
+    boxes = np.stack((x1, y1, x2, y2), axis=1) + windows[:, [0, 1, 0, 1]]
+    return boxes[keep]
+
 
 class FaceAnonymizer:
     def __init__(
@@ -24,80 +99,106 @@ class FaceAnonymizer:
         face_expand: float = 0.2,
         pixelation_factor: int = 20,
         window_sizes: int = (400, 700),
+        detect_every: int = 1,
         local_progress_callback=None,
         global_progress_callback=None,
     ) -> None:
-        self.detector = face_detection.FaceDetection(
-            min_detection_confidence=confidence, model_selection=1
-        )
+        self.detector = self._create_detector(confidence)
 
+        self.confidence = confidence
         self.face_min_size = face_min_size
         self.face_expand = face_expand
         self.pixelation_factor = pixelation_factor
         self.window_sizes = window_sizes
+        self.detect_every = detect_every
 
         self.local_progress_callback = local_progress_callback
         self.global_progress_callback = global_progress_callback
 
-    def pixelate(self, img, x1, y1, x2, y2):
-        # Pixelate the face
-        face = img[y1:y2, x1:x2]
-        pixelated_size = (
-            int((x2 - x1) / self.pixelation_factor),
-            int((y2 - y1) / self.pixelation_factor),
+        # Scratch images reused between frames of the same size
+        self._buffers = {}
+
+    def get_parameters(self):
+        return {
+            "confidence": self.confidence,
+            "face_min_size": self.face_min_size,
+            "face_expand": self.face_expand,
+            "pixelation_factor": self.pixelation_factor,
+            "window_sizes": self.window_sizes,
+            "detect_every": self.detect_every,
+        }
+
+    def set_parameters(self, **parameters):
+        unknown = parameters.keys() - self.get_parameters().keys()
+        if unknown:
+            raise TypeError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+        # Only the detector depends on confidence, and it is costly to build,
+        # so it is kept unless confidence actually changes
+        confidence = parameters.pop("confidence", self.confidence)
+        if confidence != self.confidence:
+            self.detector = self._create_detector(confidence)
+            self.confidence = confidence
+
+        for name, value in parameters.items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def _create_detector(confidence):
+        return face_detection.FaceDetection(
+            min_detection_confidence=confidence, model_selection=1
         )
-        # Check if the pixelation is too small
-        if pixelated_size[0] < 1 or pixelated_size[1] < 1:
-            return img
 
-        face = cv2.resize(face, pixelated_size)
-        face = cv2.resize(face, (x2 - x1, y2 - y1), interpolation=cv2.INTER_AREA)
-        img[y1:y2, x1:x2] = face
+    def _buffer(self, key, shape):
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[key] = np.empty(shape, dtype=np.uint8)
+        return buffer
 
-    def process_img(self, img):
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def process_img(self, img_rgb):
         faces = self.detector.process(img_rgb)
-        if faces.detections:
-            for detection in faces.detections:
-                bbox = detection.location_data.relative_bounding_box
-                h, w, _ = img.shape
-
-                # Calculate the bounding box
-                x1, y1 = int(bbox.xmin * w), int(bbox.ymin * h)
-                x2, y2 = int((bbox.xmin + bbox.width) * w), int(
-                    (bbox.ymin + bbox.height) * h
-                )
-
-                # Make the bounding box bigger
-                x1 = x1 - int(self.face_expand * (x2 - x1))
-                y1 = y1 - int(self.face_expand * (y2 - y1))
-                x2 = x2 + int(self.face_expand * (x2 - x1))
-                y2 = y2 + int(self.face_expand * (y2 - y1))
-
-                # Check if the bounding box is within the image bounds
-                x1, y1 = max(0, x1), max(0, y1)
-                x2, y2 = min(w, x2), min(h, y2)
-
-                # Check if the bounding box is too small
-                if x2 - x1 < self.face_min_size or y2 - y1 < self.face_min_size:
-                    continue
-
-                # drawing_utils.draw_detection(img, detection)
-                # cv2.imshow("face", img)
-                # cv2.waitKey(0)
-                yield (x1, y1, x2, y2)
-
-    def process(self, img):
-        w, h, _ = img.shape
-        pixelated_size = (
-            int(h / self.pixelation_factor),
-            int(w / self.pixelation_factor),
+        if not faces.detections:
+            return np.empty((0, 4))
+
+        bboxes = [
+            detection.location_data.relative_bounding_box
+            for detection in faces.detections
+        ]
+        return np.array(
+            [(bbox.xmin, bbox.ymin, bbox.width, bbox.height) for bbox in bboxes],
+            dtype=np.float64,
         )
 
-        pixelated_img = cv2.resize(img, pixelated_size)
-        pixelated_img = cv2.resize(pixelated_img, (h, w), interpolation=cv2.INTER_AREA)
+    def detect(self, img, is_rgb=False):
+        # Convert once per frame, windows are cut out of it
+        if is_rgb:
+            img_rgb = img
+        else:
+            img_rgb = cv2.cvtColor(
+                img, cv2.COLOR_BGR2RGB, dst=self._buffer("rgb", img.shape)
+            )
+        h, w, _ = img_rgb.shape
+
+        # Collect the detections of all windows and the full frame, each with
+        # the window it was found in, and post-process them all at once
+        boxes, windows = [], []
+        full_frame = ((0, 0, w, h), self.process_img(img_rgb))
+        for window, window_boxes in chain(self.sliding_windows(img_rgb), [full_frame]):
+            boxes.append(window_boxes)
+            windows.append(
+                np.array([window], dtype=np.int64).repeat(len(window_boxes), axis=0)
+            )
+
+        boxes = expand_clamp(
+            np.concatenate(boxes),
+            np.concatenate(windows),
+            self.face_expand,
+            self.face_min_size,
+        )
+        return boxes.tolist()
 
-        for x1, y1, x2, y2 in chain(self.sliding_windows(img), self.process_img(img)):
+    def anonymize(self, img, bboxes):
+        for x1, y1, x2, y2 in bboxes:
             # random_color = (
             #     random.randint(0, 255),
             #     random.randint(0, 255),
@@ -105,15 +206,36 @@ class FaceAnonymizer:
             # )
             # cv2.rectangle(img, (x1, y1), (x2, y2), random_color, 2)
 
-            img[y1:y2, x1:x2] = pixelated_img[y1:y2, x1:x2]
+            w, h = x2 - x1, y2 - y1
+            if w <= 0 or h <= 0:
+                continue
+
+            # Pixelate the face in place
+            face = img[y1:y2, x1:x2]
+            pixelated_size = (
+                max(1, int(w / self.pixelation_factor)),
+                max(1, int(h / self.pixelation_factor)),
+            )
+
+            # Nearest neighbour is a plain gather, the mosaic doesn't need filtering
+            pixelated_face = cv2.resize(
+                face, pixelated_size, interpolation=cv2.INTER_NEAREST
+            )
+            pixelated_face = cv2.resize(
+                pixelated_face, (w, h), interpolation=cv2.INTER_AREA
+            )
+            np.copyto(face, pixelated_face)
         return img
 
-    def sliding_windows(self, img):
-        for window_size in self.window_sizes:
-            yield from self.sliding_window(img, window_size)
+    def process(self, img, is_rgb=False):
+        return self.anonymize(img, self.detect(img, is_rgb))
 
-    def sliding_window(self, img, window_size):
-        w, h, _ = img.shape
+    def sliding_windows(self, img_rgb):
+        for window_size in self.active_window_sizes(img_rgb.shape):
+            yield from self.sliding_window(img_rgb, window_size)
+
+    def window_grid(self, shape, window_size):
+        h, w = shape[:2]
 
         window_step = window_size / 2
 
@@ -123,61 +245,209 @@ class FaceAnonymizer:
         step_x = int(w / windows_x)
         step_y = int(h / windows_y)
 
-        for i in range(windows_x):
-            x1 = int(i * step_x)
-            x2 = int((i + 1) * step_x)
-            for j in range(windows_y):
-                y1 = int(j * step_y)
-                y2 = int((j + 1) * step_y)
+        return windows_x, windows_y, step_x, step_y
 
-                # random_color = (
-                #     random.randint(0, 255),
-                #     random.randint(0, 255),
-                #     random.randint(0, 255),
-                # )
-                # cv2.rectangle(img, (y1, x1), (y2, x2), random_color, 2)
+    def active_window_sizes(self, shape):
+        active = []
+        seen_grids = set()
+        for window_size in self.window_sizes:
+            grid = self.window_grid(shape, window_size)
+            windows_x, windows_y, step_x, step_y = grid
+
+            # Single window covers the whole frame, already done by the full pass
+            if windows_x == 1 and windows_y == 1:
+                continue
+            # Faces found in a window can't be bigger than the window itself
+            if min(step_x, step_y) < self.face_min_size:
+                continue
+            # Different window sizes may end up with the same grid
+            if grid in seen_grids:
+                continue
+
+            seen_grids.add(grid)
+            active.append(window_size)
+        return active
+
+    def sliding_window(self, img_rgb, window_size):
+        windows_x, windows_y, step_x, step_y = self.window_grid(
+            img_rgb.shape, window_size
+        )
+        # All windows of a grid have the same size, so they share one
+        # contiguous buffer for the detector input
+        window = self._buffer(("window", window_size), (step_y, step_x, 3))
+
+        # Rectangles of all windows in the grid, row by row
+        ys, xs = np.meshgrid(
+            np.arange(windows_y) * step_y, np.arange(windows_x) * step_x, indexing="ij"
+        )
+        windows = np.stack(
+            (xs.ravel(), ys.ravel(), xs.ravel() + step_x, ys.ravel() + step_y), axis=1
+        )
+
+        for x1, y1, x2, y2 in windows.tolist():
+            # random_color = (
+            #     random.randint(0, 255),
+            #     random.randint(0, 255),
+            #     random.randint(0, 255),
+            # )
+            # cv2.rectangle(img, (x1, y1), (x2, y2), random_color, 2)
 
-                window = img[x1:x2, y1:y2]
-                for fx1, fy1, fx2, fy2 in self.process_img(window):
-                    yield (y1 + fx1, x1 + fy1, y1 + fx2, x1 + fy2)
+            np.copyto(window, img_rgb[y1:y2, x1:x2])
+            yield (x1, y1, x2, y2), self.process_img(window)
 
     def process_image_file(self, in_path: Path, out_path: Path):
         img = cv2.imread(str(in_path))
         img = self.process(img)
         cv2.imwrite(str(out_path), img)
 
-    def process_video_file(self, in_path: Path, out_path: Path):
-        capture = cv2.VideoCapture(str(in_path))
-        out = cv2.VideoWriter(
-            str(out_path),
-            cv2.VideoWriter_fourcc(*"mp4v"),
-            capture.get(cv2.CAP_PROP_FPS),
-            (
-                int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-            ),
-        )
-
-        total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        with click.progressbar(
-            length=total_frames,
-            label="Processing video frames",
-            show_pos=True,
-        ) as bar:
-            while capture.isOpened():
-                read, frame = capture.read()
-                if not read:
+    def _read_frames(self, container, stream, frames, stop):
+        try:
+            for frame in container.decode(stream):
+                if stop.is_set():
                     break
+                # Decoder output goes straight to RGB, which is what the detector needs
+                frames.put(frame.to_ndarray(format="rgb24"))
+        except Exception as e:
+            frames.put(e)
+        finally:
+            frames.put(_end_of_stream)
+
+    def _write_frames(self, output, out_stream, results, errors):
+        # Keep draining after an error so the processing loop never blocks
+        while (img := results.get()) is not _end_of_stream:
+            if errors:
+                continue
+            try:
+                # The encoder takes the RGB frame as is, no BGR round trip
+                frame = av.VideoFrame.from_ndarray(img, format="rgb24")
+                for packet in out_stream.encode(frame):
+                    output.mux(packet)
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            return
+        try:
+            # Flush the frames still buffered in the encoder
+            for packet in out_stream.encode():
+                output.mux(packet)
+        except Exception as e:
+            errors.append(e)
 
-                img = self.process(frame)
-                out.write(img)
-                bar.update(1)
-                if self.local_progress_callback:
-                    self.local_progress_callback(bar.pct)
-
-        capture.release()
-        out.release()
+    def process_video_file(self, in_path: Path, out_path: Path):
+        with av.open(str(in_path)) as container:
+            stream = container.streams.video[0]
+            # Let FFmpeg decode frames on several threads
+            stream.thread_type = "AUTO"
+
+            fps = stream.average_rate or stream.guessed_rate
+            width, height = stream.codec_context.width, stream.codec_context.height
+
+            # Picked before the output file is created, so a missing encoder
+            # doesn't leave an empty file behind
+            encoder, encoder_options = get_video_encoder(width, height)
+            click.echo(f"Encoding with {encoder}")
+
+            try:
+                with av.open(str(out_path), "w") as output:
+                    out_stream = output.add_stream(
+                        encoder, rate=fps, options=dict(encoder_options)
+                    )
+                    out_stream.width = width
+                    out_stream.height = height
+                    out_stream.pix_fmt = "yuv420p"
+                    if encoder == "mpeg4":
+                        # Same bit rate OpenCV picks for its mp4v writer
+                        out_stream.bit_rate = int(
+                            min(64 * fps * width * height, 2**31 // 2)
+                        )
+
+                    self._process_video_stream(container, stream, output, out_stream)
+            except BaseException:
+                # Don't leave a broken output file behind
+                out_path.unlink(missing_ok=True)
+                raise
+
+    @staticmethod
+    def _count_frames(container, stream):
+        if stream.frames:
+            return stream.frames
+
+        # Some containers (e.g. fragmented MP4) don't store the frame count,
+        # estimate it from the duration like OpenCV does
+        fps = stream.average_rate or stream.guessed_rate
+        if stream.duration is not None:
+            duration = stream.duration * stream.time_base
+        elif container.duration is not None:
+            duration = Fraction(container.duration, av.time_base)
+        else:
+            return 0
+        return int(duration * fps) if fps else 0
+
+    def _process_video_stream(self, container, stream, output, out_stream):
+        total_frames = self._count_frames(container, stream)
+
+        # Decode, detection and encode run concurrently, bounded queues keep
+        # memory in check when one of the stages falls behind
+        frames = queue.Queue(maxsize=8)
+        results = queue.Queue(maxsize=8)
+        stop = threading.Event()
+        write_errors = []
+
+        reader = threading.Thread(
+            target=self._read_frames,
+            args=(container, stream, frames, stop),
+            daemon=True,
+        )
+        writer = threading.Thread(
+            target=self._write_frames,
+            args=(output, out_stream, results, write_errors),
+            daemon=True,
+        )
+        reader.start()
+        writer.start()
+
+        try:
+            with click.progressbar(
+                length=total_frames,
+                label="Processing video frames",
+                show_pos=True,
+            ) as bar:
+                for frame_idx in count():
+                    # Don't keep detecting on frames that can't be written
+                    if write_errors:
+                        raise write_errors[0]
+
+                    img = frames.get()
+                    if img is _end_of_stream:
+                        break
+                    if isinstance(img, Exception):
+                        raise img
+
+                    # Faces barely move between neighbouring frames, so the
+                    # detector only runs on every detect_every-th one
+                    if frame_idx % self.detect_every == 0:
+                        bboxes = self.detect(img, is_rgb=True)
+
+                    results.put(self.anonymize(img, bboxes))
+                    bar.update(1)
+                    if self.local_progress_callback:
+                        self.local_progress_callback(bar.pct)
+        finally:
+            stop.set()
+            # Unblock the reader in case it is waiting on a full queue
+            while reader.is_alive():
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    pass
+                reader.join(0.01)
+
+            results.put(_end_of_stream)
+            writer.join()
+
+        if write_errors:
+            raise write_errors[0]
 
     def _process_file(self, filename: Path, out_filepath: Path, global_progress=0):
         if filename.suffix in video_extensions:
@@ -210,17 +480,110 @@ class FaceAnonymizer:
             for f in files_to_process
             if f.is_file() and f.suffix in supported_extensions
         ]
+        # Largest files first, so a big file doesn't start last and leave
+        # the rest of the workers idle while it finishes
         files_to_process = sorted(
-            files_to_process, key=lambda f: f.suffix in image_extensions, reverse=True
+            files_to_process, key=lambda f: f.stat().st_size, reverse=True
         )
+        images = [f for f in files_to_process if f.suffix in image_extensions]
+        videos = [f for f in files_to_process if f.suffix in video_extensions]
 
-        with click.progressbar(files_to_process, label="Processing files") as bar:
-            for filename in bar:
-                out_subpath = out_path / filename.relative_to(path).parent
-                out_subpath.mkdir(parents=True, exist_ok=True)
-                out_filepath = out_subpath / filename.name
-                click.echo("")
-                self._process_file(filename, out_filepath, bar.pct)
+        def get_out_filepath(filename):
+            out_subpath = out_path / filename.relative_to(path).parent
+            out_subpath.mkdir(parents=True, exist_ok=True)
+            return out_subpath / filename.name
+
+        with click.progressbar(
+            length=len(files_to_process), label="Processing files"
+        ) as bar:
+            # Images are independent of each other, so they go to a pool of
+            # processes, each with its own detector. When there are videos,
+            # one core is left for the video running in this process.
+            # Forking a process that already runs MediaPipe threads is unsafe
+            max_workers = None
+            if videos:
+                max_workers = max(1, min(61, (os.cpu_count() or 2) - 1))
+
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_image_worker,
+                initargs=(self.get_parameters(),),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _process_image_worker,
+                        filename,
+                        get_out_filepath(filename),
+                    ): filename
+                    for filename in images
+                }
+
+                # Images are reported as soon as they finish, from the pool's
+                # thread, so progress keeps moving while videos are processed
+                progress_lock = threading.Lock()
+                image_errors = []
+
+                def report_image(future):
+                    if future.cancelled():
+                        return
+                    error = future.exception()
+                    with progress_lock:
+                        if error is not None:
+                            image_errors.append(error)
+                            return
+                        bar.update(1)
+                        # "finished" only moves the overall progress, the file
+                        # being processed right now may still be a video
+                        if self.global_progress_callback:
+                            self.global_progress_callback(
+                                (bar.pct, "finished", futures[future])
+                            )
+                        click.echo("")
+                        click.echo(
+                            click.style(f"Saved image to {future.result()}", fg="green")
+                        )
+
+                def raise_image_errors():
+                    if image_errors:
+                        raise image_errors[0]
+
+                for future in futures:
+                    future.add_done_callback(report_image)
+
+                try:
+                    # Videos already use several threads each, process them one
+                    # by one here while the pool works through the images
+                    for filename in videos:
+                        raise_image_errors()
+                        click.echo("")
+                        self._process_file(
+                            filename, get_out_filepath(filename), bar.pct
+                        )
+                        with progress_lock:
+                            bar.update(1)
+
+                    wait(futures)
+                    raise_image_errors()
+                except BaseException:
+                    # Don't make the error wait for the images still queued
+                    for future in futures:
+                        future.cancel()
+                    raise
 
         click.echo(f"Saved anonymized files to {out_path}")
         return out_path
+
+
+# Per-process detector for the image pool, created once per worker
+_worker_anonymizer = None
+
+
+def _init_image_worker(parameters):
+    global _worker_anonymizer
+    _worker_anonymizer = FaceAnonymizer(**parameters)
+
+
+def _process_image_worker(in_path: Path, out_path: Path):
+    _worker_anonymizer.process_image_file(in_path, out_path)
+    return out_path